@@ -0,0 +1,83 @@
+      SUBROUTINE DLSODARM (F, NEQ, Y, T, TOUT, NTOUT, ITOL, RTOL, ATOL,
+     1   RWORK, LRW, IWORK, LIW, JAC, JT, G, NG, JROOT, ITERM, NMAX,
+     2   YOUT, TOUTS, RSTAT, ISTAT, NOUT, ISTATE, TROOT, YROOT, IROOT,
+     3   NROOT, IERR)
+      EXTERNAL F, JAC, G
+      INTEGER NEQ, NTOUT, ITOL, LRW, IWORK, LIW, JT, NG, JROOT, ITERM,
+     1   NMAX, ISTAT, NOUT, ISTATE, IROOT, NROOT, IERR
+      DOUBLE PRECISION Y, T, TOUT, RTOL, ATOL, RWORK, YOUT, TOUTS,
+     1   RSTAT, TROOT, YROOT
+      DIMENSION Y(NEQ), TOUT(NTOUT), RTOL(*), ATOL(*), RWORK(LRW),
+     1   IWORK(LIW), JROOT(*), ITERM(*), YOUT(NEQ,NMAX), TOUTS(NMAX),
+     2   RSTAT(4,NMAX), ISTAT(8,NMAX), TROOT(NMAX), YROOT(NEQ,NMAX),
+     3   IROOT(NMAX)
+      INTEGER I, J
+C-----------------------------------------------------------------------
+C DLSODARM drives DLSODAR over a whole array of output times in a single
+C call, so that a Python caller crosses the f2py boundary once per
+C integration instead of once per output point.
+C
+C For each TOUT(I) it calls DLSODAR (with ITASK = 1 and IOPT = 1) until
+C TOUT(I) is reached, recording every returned point (requested times
+C and root crossings) into TOUTS/YOUT together with the optional
+C statistics from RWORK and IWORK:
+C    RSTAT(1:4,K) = RWORK(11), RWORK(13), RWORK(14), RWORK(15)
+C                   (HU, TCUR, TOLSF, TSW)
+C    ISTAT(1:8,K) = IWORK(11:14), IWORK(16:19)
+C                   (NST, NFE, NJE, NQU, IMXER, LENRW, LENIW, MUSED)
+C Root crossings are additionally recorded into TROOT/YROOT/IROOT, with
+C IROOT holding the zero-based index of the first component of JROOT
+C that fired.  If ITERM of that component is nonzero, the integration
+C terminates at the root.  On an error return from DLSODAR (ISTATE
+C .LT. 0) the driver returns immediately with the points recorded so
+C far.  IERR is set to 1 if more than NMAX - NTOUT roots are found,
+C i.e. the caller-provided storage would be exhausted.
+C-----------------------------------------------------------------------
+      NOUT = 0
+      NROOT = 0
+      IERR = 0
+      ISTATE = 1
+      DO 60 I = 1,NTOUT
+ 10      CALL DLSODAR (F, NEQ, Y, T, TOUT(I), ITOL, RTOL, ATOL, 1,
+     1      ISTATE, 1, RWORK, LRW, IWORK, LIW, JAC, JT, G, NG, JROOT)
+         IF (ISTATE .LT. 0) RETURN
+         IF (ISTATE .EQ. 3 .AND. NROOT .EQ. NMAX - NTOUT) THEN
+            IERR = 1
+            RETURN
+         ENDIF
+         NOUT = NOUT + 1
+         TOUTS(NOUT) = T
+         DO 20 J = 1,NEQ
+ 20         YOUT(J,NOUT) = Y(J)
+         RSTAT(1,NOUT) = RWORK(11)
+         RSTAT(2,NOUT) = RWORK(13)
+         RSTAT(3,NOUT) = RWORK(14)
+         RSTAT(4,NOUT) = RWORK(15)
+         ISTAT(1,NOUT) = IWORK(11)
+         ISTAT(2,NOUT) = IWORK(12)
+         ISTAT(3,NOUT) = IWORK(13)
+         ISTAT(4,NOUT) = IWORK(14)
+         ISTAT(5,NOUT) = IWORK(16)
+         ISTAT(6,NOUT) = IWORK(17)
+         ISTAT(7,NOUT) = IWORK(18)
+         ISTAT(8,NOUT) = IWORK(19)
+         IF (ISTATE .NE. 3) GO TO 60
+C A root was hit at or before TOUT(I).
+         NROOT = NROOT + 1
+         TROOT(NROOT) = T
+         DO 30 J = 1,NEQ
+ 30         YROOT(J,NROOT) = Y(J)
+         IROOT(NROOT) = 0
+         DO 40 J = 1,NG
+            IF (JROOT(J) .NE. 0) THEN
+               IROOT(NROOT) = J - 1
+               GO TO 50
+            ENDIF
+ 40      CONTINUE
+ 50      IF (ITERM(IROOT(NROOT)+1) .NE. 0) RETURN
+         ISTATE = 2
+         IF (T .NE. TOUT(I)) GO TO 10
+ 60   CONTINUE
+      RETURN
+C----------------------- END OF SUBROUTINE DLSODARM --------------------
+      END
@@ -1,10 +1,45 @@
-import copy
+import ctypes
 import os
+import threading
 
+import numpy
 import scipy
 
 import _lsodar
 
+# odepack keeps its integration state in Fortran COMMON blocks, so two
+#  integrations must never run in the Fortran code at the same time. This
+#  lock is held for the duration of each integration.
+_odepack_lock = threading.Lock()
+
+# f2py will call a callback through its raw C function pointer -- skipping
+#  the Python layer entirely -- if we hand it the pointer wrapped the same
+#  way f2py wraps its own '_cpointer' attributes (a PyCObject).
+ctypes.pythonapi.PyCObject_FromVoidPtr.restype = ctypes.py_object
+ctypes.pythonapi.PyCObject_FromVoidPtr.argtypes = [ctypes.c_void_p,
+                                                   ctypes.c_void_p]
+
+def _lowlevel_pointer(obj):
+    """Extract a raw C function pointer from obj, if it carries one.
+
+    Returns a pointer object that f2py will call directly from Fortran, or
+    None if obj has to go through the usual Python callback machinery.
+    Accepts f2py-wrapped subroutines (via their _cpointer attribute),
+    numba.cfunc objects (via their address attribute), and bare integer
+    addresses.
+    """
+    if obj is None:
+        return None
+    cpointer = getattr(obj, '_cpointer', None)
+    if cpointer is not None:
+        return cpointer
+    address = getattr(obj, 'address', None)
+    if address is None and isinstance(obj, (int, long)):
+        address = obj
+    if address is not None:
+        return ctypes.pythonapi.PyCObject_FromVoidPtr(address, None)
+    return None
+
 _msgs = {2: "Integration successful.",
          3: "Integration successful. Root found.",
          -1: "Excess work done on this call (perhaps wrong Dfun type).",
@@ -16,6 +51,11 @@ _msgs = {2: "Integration successful.",
          -7: "Internal workspace insufficient to finish (internal error)."
          }
 
+# Tuple form of _msgs for plain indexed lookup on the hot path: index with
+#  istate + 7, since istate ranges from -7 to 3. The dict above stays for
+#  backward compatibility with code that reads it.
+_MSGS = tuple([_msgs.get(ii, '') for ii in range(-7, 4)])
+
 _rwork_vars = {'hu': 10,
               'tcur': 12,
               'tolsf': 13,
@@ -30,6 +70,41 @@ _iwork_vars = {'nst': 10,
               'mused': 18,
               }
 
+# Precomputed key and index arrays for the full_output statistics, so the
+#  integration loop can gather all of them with a single take() per recorded
+#  point instead of a dict iteration. The explicit key order matches the
+#  columns the dlsodarm driver records its statistics in.
+_RWORK_KEYS = ('hu', 'tcur', 'tolsf', 'tsw')
+_RWORK_IDX = scipy.array([_rwork_vars[key] for key in _RWORK_KEYS])
+_IWORK_KEYS = ('nst', 'nfe', 'nje', 'nqu', 'imxer', 'lenrw', 'leniw',
+               'mused')
+_IWORK_IDX = scipy.array([_iwork_vars[key] for key in _IWORK_KEYS])
+_ALL_INFO_KEYS = _RWORK_KEYS + _IWORK_KEYS
+
+def _prep_tol(rtol, atol, neq):
+    """Validate the tolerance settings and return (itol, rtol, atol).
+
+    The tolerances come back as contiguous float64 arrays of the final
+    shape, so f2py doesn't re-coerce Python sequences on every call into
+    the Fortran side. Unset tolerances default to 1.49012e-8, as in
+    scipy.integrate.odeint.
+    """
+    if rtol is None:
+        rtol = 1.49012e-8
+    if atol is None:
+        atol = 1.49012e-8
+    rtol = numpy.asarray(rtol, numpy.float64)
+    atol = numpy.asarray(atol, numpy.float64)
+    rtol_seq = rtol.ndim > 0
+    atol_seq = atol.ndim > 0
+    if rtol_seq and len(rtol) != neq:
+        raise ValueError, 'Vector array of tolerances must have same length as number of equations!'
+    if atol_seq and len(atol) != neq:
+        raise ValueError, 'Vector array of tolerances must have same length as number of equations!'
+    #  1: both scalar, 2: atol a vector, 3: rtol a vector, 4: both vectors.
+    itol = 1 + 2*int(rtol_seq) + int(atol_seq)
+    return itol, numpy.atleast_1d(rtol), numpy.atleast_1d(atol)
+
 def odeintr(func, y0, t, args=(), Dfun=None, col_deriv=0, full_output=0, ml=0, mu=0, rtol=None, atol=None, tcrit=None, h0=0.0, hmax=0.0, hmin=0.0, ixpr=0, mxstep=500, mxhnil=0, mxordn=12, mxords=5, printmessg=0, root_term = [], root_func=None, int_pts=False):
     """Integrate a system of ordinary differential equations.
 
@@ -55,16 +130,25 @@ def odeintr(func, y0, t, args=(), Dfun=None, col_deriv=0, full_output=0, ml=0, m
     Inputs:
 
       func -- func(y,t0,...) computes the derivative of y at t0.
+              The returned array is copied out immediately, so func (and
+              Dfun and root_func) may overwrite and return the same
+              preallocated buffer on every call.
       y0   -- initial condition on y (can be a vector).
       t    -- a sequence of time points for which to solve for y.  The intial
               value point should be the first element of this sequence.
       args -- extra arguments to pass to function.
       Dfun -- the gradient (Jacobian) of func (same input signature as func).
-      ****
+              Supplying Dfun makes lsodar treat it as an exact dense
+              Jacobian (jt = 1), replacing the neq extra func calls per
+              Jacobian update that internal finite differencing costs --
+              well worth it for small stiff systems.
       col_deriv -- non-zero implies that Dfun defines derivatives down
-                   columns (faster), otherwise Dfun should define derivatives
-                   across rows.
-      **** Not yet working!
+                   columns (faster: that is the Fortran storage order lsodar
+                   wants, so the returned array is handed over without a
+                   copy), otherwise Dfun should define derivatives across
+                   rows. Ignored for compiled Dfun callbacks, which always
+                   fill pd in Fortran order. Returning a Fortran-ordered
+                   array from a row-style Dfun avoids the copy too.
       full_output -- non-zero to return a dictionary of optional outputs as
                      the second output.
       printmessg -- print the convergence message.
@@ -77,6 +161,18 @@ def odeintr(func, y0, t, args=(), Dfun=None, col_deriv=0, full_output=0, ml=0, m
                    values, y values, and indices of the roots found. The times
                    at which roots were found are inserted into yout and tout.
 
+      func, Dfun and root_func may alternatively be compiled callbacks
+      carrying a raw C function pointer: a numba.cfunc, an f2py-wrapped
+      subroutine, or a bare integer address. These are called directly from
+      Fortran, without crossing back into Python on every step, which
+      removes most of the call overhead for small systems. The required
+      signatures are those lsodar itself uses (all arguments are pointers):
+          func(neq, t, y, ydot)
+          Dfun(neq, t, y, ml, mu, pd, nrowpd)  -- pd in Fortran order,
+                                                  leading dimension nrowpd
+          root_func(neq, t, y, ng, gout)
+      args must be empty for compiled callbacks.
+
 
     Outputs: (y, {tout, t_root, y_root, i_root, infodict,})
 
@@ -147,46 +243,64 @@ def odeintr(func, y0, t, args=(), Dfun=None, col_deriv=0, full_output=0, ml=0, m
 
     """
 
-    # Take care of our passed in functions. We need to wrap them in lambda's to
-    #  pass on the extra arguments
-    usefunc = lambda t, y: func(y, t, *args)
-    if len(root_term) > 0 and root_func is not None:
-        useg = lambda t, y: root_func(y, t, *args)
+    # Take care of our passed in functions. Callbacks carrying a raw C
+    #  function pointer (numba.cfunc's, f2py-wrapped subroutines) go straight
+    #  to the Fortran side; plain Python callables get wrapped in lambda's to
+    #  reorder the arguments and pass on the extra ones.
+    usefunc = _lowlevel_pointer(func)
+    func_compiled = usefunc is not None
+    if not func_compiled:
+        usefunc = lambda t, y: func(y, t, *args)
+    elif args:
+        raise ValueError, 'args are not supported with compiled callbacks!'
+    # The g and jac callbacks are never invoked when roots aren't sought or
+    #  no Jacobian is supplied, so they don't hold up the GIL-free path then.
+    g_compiled, jac_compiled = True, True
+    if len(root_term) > 0:
+        # lsodar will call g once roots are sought, so a missing root_func
+        #  must be caught here rather than blowing up inside Fortran.
+        if root_func is None:
+            raise ValueError, 'root_term was given without a root_func!'
+        useg = _lowlevel_pointer(root_func)
+        g_compiled = useg is not None
+        if not g_compiled:
+            useg = lambda t, y: root_func(y, t, *args)
     else:
         useg = lambda x: x
     if Dfun is not None:
-        usejac = lambda t, y: Dfun(y, t, *args)
+        usejac = _lowlevel_pointer(Dfun)
+        jac_compiled = usejac is not None
+        if not jac_compiled:
+            if col_deriv:
+                # The transpose of the user's column-ordered array is both
+                #  the row layout the f2py wrapper expects and Fortran-
+                #  contiguous, so it is passed through without a copy.
+                usejac = lambda t, y: Dfun(y, t, *args).transpose()
+            else:
+                usejac = lambda t, y: Dfun(y, t, *args)
         Dfun_def = True
     else:
         usejac = lambda x: x
         Dfun_def = False
 
+    # When every callback lsodar will invoke is a compiled pointer, the
+    #  integration never re-enters Python and can run with the GIL
+    #  released, letting other threads make progress meanwhile.
+    if func_compiled and g_compiled and jac_compiled:
+        dlsodar_, dlsodarm_ = _lsodar.dlsodar_nogil, _lsodar.dlsodarm_nogil
+    else:
+        dlsodar_, dlsodarm_ = _lsodar.dlsodar, _lsodar.dlsodarm
+
+    # lsodar's y argument is intent(in, out): when y0 is already a
+    #  C-contiguous float64 ndarray f2py passes it straight through and the
+    #  Fortran side overwrites it. Take a private copy so the caller's y0
+    #  survives the integration.
+    y0 = numpy.array(y0, numpy.float64)
     neq = len(y0)
     ng = len(root_term)
 
     # Now we take care of the tolerance settings
-    try:
-        rlen = len(rtol)
-    except TypeError:
-        rtol_seq = False
-    else:
-        if rlen != neq:
-            raise ValueError, 'Vector array of tolerances must have same length as number of equations!'
-        rtol_seq = True
-    try:
-        alen = len(atol)
-    except TypeError:
-        atol_seq = False
-    else:
-        if alen != neq:
-            raise ValueError, 'Vector array of tolerances must have same length as number of equations!'
-        atol_seq = True
-
-    # Figure out what itol should be.
-    itol = {(False, False): 1,
-            (False, True): 2,
-            (True, False): 3,
-            (True, True): 4}[rtol_seq, atol_seq]
+    itol, rtol, atol = _prep_tol(rtol, atol, neq)
 
     itask = 1
     # Do we have critical points?
@@ -197,10 +311,11 @@ def odeintr(func, y0, t, args=(), Dfun=None, col_deriv=0, full_output=0, ml=0, m
         #  output mode. To make sure we return results for the requested times,
         #  we add them to our critical times list.
         if tcrit:
-            tcrit_set = sets.Set(tcrit)
-            tcrit_set.union_update(t[1:])
-            tcrit = list(tcrit_set)
-            tcrit.sort()
+            # One C-level sort, instead of building Python sets of boxed
+            #  floats. unique() also drops duplicated time points.
+            tcrit = numpy.unique(numpy.concatenate(
+                    (numpy.asarray(tcrit, numpy.float64),
+                     numpy.asarray(t[1:], numpy.float64))))
         else:
             tcrit = t[1:]
         itask = 5
@@ -208,22 +323,31 @@ def odeintr(func, y0, t, args=(), Dfun=None, col_deriv=0, full_output=0, ml=0, m
     # Is our jacobian banded?
     banded_jac = (ml > 0) or (mu > 0)
 
-    # Set jacobian type
-    jt = {(True, False): 1,
-          (False, False): 2,
-          (True, True): 4,
-          (False, True): 5}[Dfun_def, banded_jac]
+    # Set jacobian type.
+    #  1: user-supplied dense, 2: internal dense,
+    #  4: user-supplied banded, 5: internal banded.
+    jt = 2 - int(Dfun_def) + 3*int(banded_jac)
 
 
-    # Make the work arrays
-    lmat = max(neq**2 + 2, (2*ml + mu + 1)*neq + 2)
+    # Make the work arrays. The Jacobian block of rwork is sized for the
+    #  Jacobian type actually selected, so small dense systems don't pay
+    #  for banded storage or the other way around.
+    if banded_jac:
+        lmat = (2*ml + mu + 1)*neq + 2
+    else:
+        lmat = neq**2 + 2
     lrn = 20 + neq*(mxordn+4) + 3*ng
     lrs = 20 + neq*(mxords+4) + lmat + 3*ng
     lrw = max(lrn, lrs)
-    rwork = scipy.zeros(lrw, scipy.float64)
+    # lsodar only reads the first 20 entries of the work arrays (the
+    #  optional-input region) before writing to them, so there's no need to
+    #  zero-fill the whole workspace on every call.
+    rwork = numpy.empty(lrw, numpy.float64)
+    rwork[:20] = 0.0
 
     liw = 20 + neq
-    iwork = scipy.zeros(liw, scipy.int32)
+    iwork = numpy.empty(liw, numpy.int32)
+    iwork[:20] = 0
 
 
     rwork[4] = h0
@@ -237,81 +361,189 @@ def odeintr(func, y0, t, args=(), Dfun=None, col_deriv=0, full_output=0, ml=0, m
     iwork[7] = mxordn
     iwork[8] = mxords
 
+    # The single most common call shape -- integrate from t[0] to t[1] with
+    #  no roots, critical points or statistics -- needs none of the
+    #  bookkeeping below: one lsodar call and a two-row result.
+    if (len(t) == 2 and not full_output and not int_pts
+        and ng == 0 and not tcrit):
+        # Record the initial condition before the call: lsodar overwrites
+        #  its y argument in place.
+        yout_buf = numpy.empty((2, neq), numpy.float64)
+        yout_buf[0] = y0
+        _odepack_lock.acquire()
+        try:
+            y, treached, istate, jroot = \
+                    dlsodar_(usefunc, y0, t[0], t[1],
+                                    itol, rtol, atol,
+                                    1, 1, rwork, iwork,
+                                    usejac, jt,
+                                    useg, 0)
+        finally:
+            _odepack_lock.release()
+        yout_buf[1] = y
+        if istate < 0:
+            # Problem! Like the other paths, return only the rows that
+            #  were actually reached.
+            print _MSGS[istate + 7]
+            print "Run with full_output = 1 to get quantitative information."
+            return yout_buf[:1]
+        if printmessg:
+            print _MSGS[istate + 7]
+        return yout_buf
+
     istate = 1 # First call
     t0, tindex = t[0], 1
-    tout, yout = [t0], [y0]
     t_root, y_root, i_root = [], [], []
 
-    info_dict = dict([(key, []) for key in
-                      (_rwork_vars.keys() + _iwork_vars.keys())])
-    tcrit_ii = 0
-    while tindex < len(t):
-        twanted = t[tindex]
-        if (itask == 4 or itask == 5) and tcrit_ii < len(tcrit):
-            rwork[0] = tcrit[tcrit_ii]
-            twanted = min(tcrit[tcrit_ii], twanted)
-
-
-
-        y, treached, istate, jroot = \
-                _lsodar.dlsodar(usefunc, y0, t0, twanted,
-                                itol, rtol, atol,
-                                itask, istate, rwork, iwork,
-                                usejac, jt,
-                                useg, ng)
-
-        if istate < 0:
-            # Problem!
-            print _msgs[istate]
-            print "Run with full_output = 1 to get quantitative information."
-            break
+    # Only pay for the statistics dictionary when the caller asked for it.
+    if full_output:
+        info_dict = dict([(key, []) for key in _ALL_INFO_KEYS])
+    rwork_rows, iwork_rows = [], []
+    # Serialize: odepack is not reentrant (see _odepack_lock).
+    _odepack_lock.acquire()
+    try:
+        if itask == 1:
+            # No critical points and no intermediate output requested: hand the
+            #  whole sweep over t to the Fortran driver, which crosses the f2py
+            #  boundary once per integration instead of once per output time.
+            if ng > 0:
+                iterm = scipy.array(root_term, scipy.int32)
+                maxroot = max(100, 10*len(t))
+            else:
+                iterm = scipy.zeros(1, scipy.int32)
+                maxroot = 0
+            nmax = len(t) - 1 + maxroot
+            # The driver writes the final state back into its y argument, so
+            #  hand it a scratch copy: y0 is still needed for the first row
+            #  of the output below.
+            (y, treached, y_out, touts, rstat, istat, nout, istate,
+             troot, yroot, iroot, nroot, ierr) = \
+                    dlsodarm_(usefunc, y0.copy(), t0, t[1:],
+                                     itol, rtol, atol, rwork, iwork,
+                                     usejac, jt, useg, ng, iterm, nmax)
+            n_out = 1 + nout
+            yout_buf = numpy.empty((n_out, neq), numpy.float64)
+            tout_buf = numpy.empty(n_out, numpy.float64)
+            yout_buf[0] = y0
+            tout_buf[0] = t0
+            yout_buf[1:] = y_out[:, :nout].transpose()
+            tout_buf[1:] = touts[:nout]
+            t_root = list(troot[:nroot])
+            y_root = [yroot[:, ii].copy() for ii in range(nroot)]
+            i_root = list(iroot[:nroot])
+            if full_output:
+                rwork_rows = list(rstat[:, :nout].transpose())
+                iwork_rows = list(istat[:, :nout].transpose())
+                info_dict['message'] = _MSGS[istate + 7]
+            if ierr:
+                print 'Too many roots found; integration stopped early.'
+            if istate < 0:
+                # Problem!
+                print _MSGS[istate + 7]
+                print "Run with full_output = 1 to get quantitative information."
+            elif printmessg:
+                print _MSGS[istate + 7]
         else:
-            if printmessg:
-                print _msgs[istate]
-
-            # If we need to record this point.
-            if treached == t[tindex] or itask == 5 or istate == 3:
-                yout.append(y)
-                tout.append(treached)
-                if full_output:
-                    for key, index in _rwork_vars.items():
-                        info_dict[key].append(rwork[index])
-                    for key, index in _iwork_vars.items():
-                        info_dict[key].append(iwork[index])
-                    info_dict['message'] = _msgs[istate]
-
-            # If we reached our goal, move on to the next point.
-            if treached == t[tindex]:
-                tindex += 1
-
-            # If we reached a critical point, move to the next
-            if itask == 4 or itask == 5 and treached == tcrit[tcrit_ii]:
-                tcrit_ii += 1
-                # If we're out of critical points, drop back to normal
-                #  integration mode
-                if tcrit_ii == len(tcrit):
-                    itask = 1
-
-            # We've found a root
-            if istate == 3:
-                jroot = list(jroot)
-                if jroot.count(1) != 1:
-                    print 'Multiple roots found at a single point!?! jroot is %s' % jroot
-
-                # Which root did we hit?
-                crossed = jroot.index(1)
-
-                t_root.append(treached)
-                y_root.append(copy.copy(y))
-                i_root.append(crossed)
-
-                if root_term[crossed] == 1:
+            # Preallocate the output buffers to their expected size and grow
+            #  geometrically if an int_pts run records more points than that.
+            nalloc = len(t) + 1
+            if itask == 4 or itask == 5:
+                nalloc += len(tcrit)
+            yout_buf = numpy.empty((nalloc, neq), numpy.float64)
+            tout_buf = numpy.empty(nalloc, numpy.float64)
+            yout_buf[0] = y0
+            tout_buf[0] = t0
+            n_out = 1
+            tcrit_ii = 0
+            while tindex < len(t):
+                twanted = t[tindex]
+                if (itask == 4 or itask == 5) and tcrit_ii < len(tcrit):
+                    rwork[0] = tcrit[tcrit_ii]
+                    twanted = min(tcrit[tcrit_ii], twanted)
+
+
+
+                y, treached, istate, jroot = \
+                        dlsodar_(usefunc, y0, t0, twanted,
+                                        itol, rtol, atol,
+                                        itask, istate, rwork, iwork,
+                                        usejac, jt,
+                                        useg, ng)
+
+                if istate < 0:
+                    # Problem!
+                    print _MSGS[istate + 7]
+                    print "Run with full_output = 1 to get quantitative information."
                     break
+                else:
+                    if printmessg:
+                        print _MSGS[istate + 7]
+
+                    # If we need to record this point.
+                    if treached == t[tindex] or itask == 5 or istate == 3:
+                        if n_out == nalloc:
+                            nalloc *= 2
+                            yout_buf = numpy.resize(yout_buf, (nalloc, neq))
+                            tout_buf = numpy.resize(tout_buf, nalloc)
+                        yout_buf[n_out] = y
+                        tout_buf[n_out] = treached
+                        n_out += 1
+                        if full_output:
+                            rwork_rows.append(rwork.take(_RWORK_IDX))
+                            iwork_rows.append(iwork.take(_IWORK_IDX))
+                            info_dict['message'] = _MSGS[istate + 7]
+
+                    # If we reached our goal, move on to the next point.
+                    if treached == t[tindex]:
+                        tindex += 1
+
+                    # If we reached a critical point, move to the next
+                    if itask == 4 or itask == 5 and treached == tcrit[tcrit_ii]:
+                        tcrit_ii += 1
+                        # If we're out of critical points, drop back to normal
+                        #  integration mode
+                        if tcrit_ii == len(tcrit):
+                            itask = 1
+
+                    # We've found a root
+                    if istate == 3:
+                        # Which root did we hit?
+                        hits = numpy.flatnonzero(jroot)
+                        if len(hits) != 1:
+                            print 'Multiple roots found at a single point!?! jroot is %s' % list(jroot)
+                        crossed = int(hits[0])
+
+                        t_root.append(treached)
+                        # When y0 comes in as a float64 ndarray, f2py passes
+                        #  it through, so every iteration returns the same
+                        #  object and we must copy before recording it.
+                        y_root.append(y.copy())
+                        i_root.append(crossed)
+
+                        if root_term[crossed] == 1:
+                            break
+
+    finally:
+        _odepack_lock.release()
+
+    # Unpack the gathered statistics into per-key arrays: callers get
+    #  contiguous float64/int32 vectors instead of lists of boxed scalars.
+    if full_output:
+        rstats = numpy.array(rwork_rows, numpy.float64)
+        istats = numpy.array(iwork_rows, numpy.int32)
+        if not rwork_rows:
+            rstats = rstats.reshape((0, len(_RWORK_KEYS)))
+            istats = istats.reshape((0, len(_IWORK_KEYS)))
+        for ii, key in enumerate(_RWORK_KEYS):
+            info_dict[key] = numpy.ascontiguousarray(rstats[:, ii])
+        for ii, key in enumerate(_IWORK_KEYS):
+            info_dict[key] = numpy.ascontiguousarray(istats[:, ii])
 
     # Process outputs
-    outputs = (scipy.array(yout),)
+    outputs = (yout_buf[:n_out],)
     if int_pts or ng > 0:
-        outputs = outputs + (tout,)
+        # tout stays a list, as documented.
+        outputs = outputs + (tout_buf[:n_out].tolist(),)
     if ng > 0:
         outputs = outputs + (t_root, y_root, i_root)
     if full_output:
@@ -321,3 +553,14 @@ def odeintr(func, y0, t, args=(), Dfun=None, col_deriv=0, full_output=0, ml=0, m
         return outputs[0]
     else:
         return outputs
+
+def odeintr_lowlevel(func_ptr, y0, t, jac_ptr=None, g_ptr=None, **kwargs):
+    """Integrate a system of odes using compiled callbacks only.
+
+    A thin wrapper around odeintr for callers who have compiled their
+    right-hand side (and optionally Jacobian and root function) down to raw
+    C function pointers, e.g. with numba.cfunc. See the odeintr docstring
+    for the required callback signatures; all other keyword arguments are
+    passed through to odeintr.
+    """
+    return odeintr(func_ptr, y0, t, Dfun=jac_ptr, root_func=g_ptr, **kwargs)
@@ -1,37 +1,83 @@
 import time
 
+import numpy
 import scipy
 from scipy.integrate import odeint
 
 from lsodar import *
 
-def func(y, t):
-    ydot = scipy.zeros(3, scipy.float64)
-    ydot[0] = -0.04 * y[0] + 1e4*y[1]*y[2]
-    ydot[1] = 0.04 * y[0] - 1e4*y[1]*y[2] - 3e7*y[1]**2
-    ydot[2] = 3e7*y[1]**2
-    return ydot
-
-def Dfun(y, t):
-    pd = scipy.zeros((3,3), scipy.float64)
-    pd[0,0] = -0.04
-    pd[0,1] = 1e4*y[2]
-    pd[0,2] = 1e4*y[1]
-    pd[1,0] = 0.04
-    pd[1,1] = -1e4*y[2] - 6e7*y[1]
-    pd[1,2] = -1e4*y[1]
-    pd[2,1] = 6e7*y[1]
-    return pd
-
-def root_func(y, t):
-    out = scipy.zeros(2, scipy.float64)
-    out[0] = y[0] - 1e-4
-    out[1] = y[2] - 1e-2
-    return out
+try:
+    from numba import njit
+except ImportError:
+    njit = None
+
+if njit is not None:
+    # Fully compiled callbacks. Allocation inside a jitted function is cheap,
+    #  so there's no need for the preallocated buffers of the fallback path.
+    @njit(cache=True, fastmath=True)
+    def func(y, t):
+        ydot = numpy.empty(3)
+        ydot[0] = -0.04 * y[0] + 1e4*y[1]*y[2]
+        ydot[1] = 0.04 * y[0] - 1e4*y[1]*y[2] - 3e7*y[1]**2
+        ydot[2] = 3e7*y[1]**2
+        return ydot
+
+    @njit(cache=True, fastmath=True)
+    def Dfun(y, t):
+        pd = numpy.zeros((3,3))
+        pd[0,0] = -0.04
+        pd[0,1] = 1e4*y[2]
+        pd[0,2] = 1e4*y[1]
+        pd[1,0] = 0.04
+        pd[1,1] = -1e4*y[2] - 6e7*y[1]
+        pd[1,2] = -1e4*y[1]
+        pd[2,1] = 6e7*y[1]
+        return pd
+
+    @njit(cache=True, fastmath=True)
+    def root_func(y, t):
+        out = numpy.empty(2)
+        out[0] = y[0] - 1e-4
+        out[1] = y[2] - 1e-2
+        return out
+else:
+    # The integrator copies out of the returned arrays immediately, so the
+    #  callbacks can overwrite a single preallocated buffer instead of paying
+    #  for an allocation on every one of the thousands of calls per run.
+    _YDOT = scipy.empty(3, scipy.float64)
+    _PD = scipy.zeros((3,3), scipy.float64, order='F')
+    _ROOT = scipy.empty(2, scipy.float64)
+
+    def func(y, t, _out=_YDOT):
+        _out[0] = -0.04 * y[0] + 1e4*y[1]*y[2]
+        _out[1] = 0.04 * y[0] - 1e4*y[1]*y[2] - 3e7*y[1]**2
+        _out[2] = 3e7*y[1]**2
+        return _out
+
+    def Dfun(y, t, _out=_PD):
+        _out[0,0] = -0.04
+        _out[0,1] = 1e4*y[2]
+        _out[0,2] = 1e4*y[1]
+        _out[1,0] = 0.04
+        _out[1,1] = -1e4*y[2] - 6e7*y[1]
+        _out[1,2] = -1e4*y[1]
+        _out[2,1] = 6e7*y[1]
+        return _out
+
+    def root_func(y, t, _out=_ROOT):
+        _out[0] = y[0] - 1e-4
+        _out[1] = y[2] - 1e-2
+        return _out
 
 y0 = [1.0, 0, 0]
 t = scipy.array([0] + [4 * 10**x for x in range(-1, 11)])
 
+# Warm up: make sure JIT compilation happens outside the timing loops.
+_ywarm = scipy.asarray(y0, scipy.float64)
+func(_ywarm, 0.0)
+Dfun(_ywarm, 0.0)
+root_func(_ywarm, 0.0)
+
 start_time = time.clock()
 for ii in range(1000):
     y = odeintr(func, y0, t, Dfun=Dfun,
@@ -8,34 +8,104 @@ odeintr = lsodar.odeintr
 # XXX: I don't understand the banded jacobian case properly, so I don't have
 #      tests for it.
 
-# This test problem is from the lsodar documentation.
-def func(y, t):
-    ydot = scipy.zeros(3, scipy.float64)
-    ydot[0] = -0.04 * y[0] + 1e4*y[1]*y[2]
-    ydot[1] = 0.04 * y[0] - 1e4*y[1]*y[2] - 3e7*y[1]**2
-    ydot[2] = 3e7*y[1]**2
-    return ydot
-
-def Dfun(y, t):
-    pd = scipy.zeros((3,3), scipy.float64)
-    pd[0,0] = -0.04
-    pd[0,1] = 1e4*y[2]
-    pd[0,2] = 1e4*y[1]
-    pd[1,0] = 0.04
-    pd[1,1] = -1e4*y[2] - 6e7*y[1]
-    pd[1,2] = -1e4*y[1]
-    pd[2,1] = 6e7*y[1]
-    return pd
-
-def root_func(y, t):
-    out = scipy.zeros(2, scipy.float64)
-    out[0] = y[0] - 1e-4
-    out[1] = y[2] - 1e-2
-    return out
+# This test problem is from the lsodar documentation. The callbacks reuse
+#  preallocated output buffers; odeintr copies out of the returned array
+#  immediately, so this is safe and avoids an allocation per call.
+_YDOT = scipy.empty(3, scipy.float64)
+_PD = scipy.zeros((3,3), scipy.float64, order='F')
+_ROOT = scipy.empty(2, scipy.float64)
+
+def func(y, t, _out=_YDOT):
+    _out[0] = -0.04 * y[0] + 1e4*y[1]*y[2]
+    _out[1] = 0.04 * y[0] - 1e4*y[1]*y[2] - 3e7*y[1]**2
+    _out[2] = 3e7*y[1]**2
+    return _out
+
+def Dfun(y, t, _out=_PD):
+    _out[0,0] = -0.04
+    _out[0,1] = 1e4*y[2]
+    _out[0,2] = 1e4*y[1]
+    _out[1,0] = 0.04
+    _out[1,1] = -1e4*y[2] - 6e7*y[1]
+    _out[1,2] = -1e4*y[1]
+    _out[2,1] = 6e7*y[1]
+    return _out
+
+def root_func(y, t, _out=_ROOT):
+    _out[0] = y[0] - 1e-4
+    _out[1] = y[2] - 1e-2
+    return _out
+
+_PDT = scipy.zeros((3,3), scipy.float64)
+
+def Dfun_col(y, t, _out=_PDT):
+    # Derivatives down columns: _out[j,i] = d func_i / d y_j.
+    _out[0,0] = -0.04
+    _out[1,0] = 1e4*y[2]
+    _out[2,0] = 1e4*y[1]
+    _out[0,1] = 0.04
+    _out[1,1] = -1e4*y[2] - 6e7*y[1]
+    _out[2,1] = -1e4*y[1]
+    _out[1,2] = 6e7*y[1]
+    return _out
 
 y0 = [1.0, 0, 0]
 t = scipy.array([0] + [4 * 10**x for x in range(-1, 11)])
 
+# Compiled versions of the same problem, for the low-level callback path
+#  and for the jitted-callable path.
+try:
+    from numba import cfunc, njit, types
+except ImportError:
+    cfunc = None
+else:
+    @njit(cache=True, fastmath=True)
+    def func_jit(y, t):
+        ydot = scipy.empty(3)
+        ydot[0] = -0.04*y[0] + 1e4*y[1]*y[2]
+        ydot[1] = 0.04*y[0] - 1e4*y[1]*y[2] - 3e7*y[1]**2
+        ydot[2] = 3e7*y[1]**2
+        return ydot
+
+    @njit(cache=True, fastmath=True)
+    def Dfun_jit(y, t):
+        pd = scipy.zeros((3,3))
+        pd[0,0] = -0.04
+        pd[0,1] = 1e4*y[2]
+        pd[0,2] = 1e4*y[1]
+        pd[1,0] = 0.04
+        pd[1,1] = -1e4*y[2] - 6e7*y[1]
+        pd[1,2] = -1e4*y[1]
+        pd[2,1] = 6e7*y[1]
+        return pd
+
+    _dp = types.CPointer(types.float64)
+    _ip = types.CPointer(types.intc)
+
+    @cfunc(types.void(_ip, _dp, _dp, _dp))
+    def func_ll(neq, t, y, ydot):
+        ydot[0] = -0.04*y[0] + 1e4*y[1]*y[2]
+        ydot[1] = 0.04*y[0] - 1e4*y[1]*y[2] - 3e7*y[1]*y[1]
+        ydot[2] = 3e7*y[1]*y[1]
+
+    @cfunc(types.void(_ip, _dp, _dp, _ip, _ip, _dp, _ip))
+    def Dfun_ll(neq, t, y, ml, mu, pd, nrowpd):
+        # pd is in Fortran order, with leading dimension nrowpd, and is
+        #  preset to zero by lsodar.
+        n = nrowpd[0]
+        pd[0] = -0.04
+        pd[1] = 0.04
+        pd[n] = 1e4*y[2]
+        pd[n + 1] = -1e4*y[2] - 6e7*y[1]
+        pd[n + 2] = 6e7*y[1]
+        pd[2*n] = 1e4*y[1]
+        pd[2*n + 1] = -1e4*y[1]
+
+    @cfunc(types.void(_ip, _dp, _dp, _ip, _dp))
+    def root_func_ll(neq, t, y, ng, gout):
+        gout[0] = y[0] - 1e-4
+        gout[1] = y[2] - 1e-2
+
 class test_lsodar(unittest.TestCase):
     def test_basic(self):
         """ Basic test of lsodar """
@@ -53,6 +123,14 @@ class test_lsodar(unittest.TestCase):
         self.assertAlmostEqual(y[1][1], 3.386380e-5, 4)
         self.assertAlmostEqual(y[6][2], 9.610125e-1, 4)
 
+    def test_col_deriv(self):
+        """ Test column-ordered user-supplied Jacobian """
+        y = odeintr(func, y0, t, Dfun=Dfun_col, col_deriv=True,
+                    rtol=1e-4, atol=[1e-6, 1e-10, 1e-6])
+
+        self.assertAlmostEqual(y[1][1], 3.386380e-5, 4)
+        self.assertAlmostEqual(y[6][2], 9.610125e-1, 4)
+
     def test_full_output(self):
         """ Test full_output """
         y, info_dict = odeintr(func, y0, t, Dfun=Dfun,
@@ -220,6 +298,53 @@ class test_lsodar(unittest.TestCase):
         self.assertEqual(tout[-1], t_root[1])
         self.assertEqual(y[-1][0], y_root[1][0])
 
+    def test_roots_ndarray_y0_driver(self):
+        """ Test root finding on the Fortran driver path with ndarray y0 """
+        # Row 0 of the output must stay the initial condition, and the
+        #  caller's array must come back untouched, even though f2py passes
+        #  a float64 ndarray y0 to the Fortran side without a copy.
+        root_term = [0, 0]
+        y0_arr = scipy.asarray(y0, scipy.float64)
+        y, tout, t_root, y_root, i_root = \
+                odeintr(func, y0_arr, t, Dfun=Dfun, rtol=1e-4,
+                        atol=[1e-6, 1e-10, 1e-6],
+                        root_func = root_func, root_term = root_term)
+
+        self.assertEqual(y[0][0], 1.0)
+        self.assertEqual(y0_arr[0], 1.0)
+        self.assertAlmostEqual(t_root[0], 2.6400e-1, 4)
+        self.assertAlmostEqual(y_root[0][1], 3.470563e-5, 4)
+        self.assertEqual(i_root[0], 1)
+
+    def test_roots_ndarray_y0(self):
+        """ Test root finding on the tcrit loop path with ndarray y0 """
+        # With a float64 ndarray y0, f2py passes the same array in and out
+        #  of every lsodar call, so the recorded root states must be copies
+        #  or they all end up aliasing the final state.
+        root_term = [0, 0]
+        y, tout, t_root, y_root, i_root = \
+                odeintr(func, scipy.asarray(y0, scipy.float64), t,
+                        Dfun=Dfun, rtol=1e-4,
+                        atol=[1e-6, 1e-10, 1e-6],
+                        root_func = root_func, root_term = root_term,
+                        tcrit = [0.2, 0.9, 1.7])
+
+        self.assertAlmostEqual(t_root[0], 2.6400e-1, 4)
+        self.assertAlmostEqual(y_root[0][1], 3.470563e-5, 4)
+        self.assertEqual(i_root[0], 1)
+        self.assertAlmostEqual(y_root[1][1], 4.000395e-10, 4)
+        self.assertEqual(i_root[1], 0)
+
+    def test_two_point_ndarray_y0(self):
+        """ Test the two-point fast path with ndarray y0 """
+        y0_arr = scipy.asarray(y0, scipy.float64)
+        y = odeintr(func, y0_arr, [0.0, 0.4], Dfun=Dfun, rtol=1e-4,
+                    atol=[1e-6, 1e-10, 1e-6])
+
+        self.assertEqual(y[0][1], 0.0)
+        self.assertEqual(y0_arr[1], 0.0)
+        self.assertAlmostEqual(y[1][1], 3.386380e-5, 4)
+
     def test_int_pts(self):
         """ Test intermediate output """
         y, tout = odeintr(func, y0, t,
@@ -232,6 +357,16 @@ class test_lsodar(unittest.TestCase):
         self.assertAlmostEqual(y[out_index][2], 9.610125e-1, 4)
         self.assertEqual(t[-1], tout[-1])
 
+    def test_int_pts_tcrit(self):
+        """ Test intermediate output combined with critical times """
+        y, tout = odeintr(func, y0, t,
+                          rtol = 1e-4, atol = [1e-6, 1e-10, 1e-6],
+                          tcrit = [0.2, 0.9, 1.7], int_pts = True)
+
+        out_index = tout.index(t[1])
+        self.assertAlmostEqual(y[out_index][1], 3.386380e-5, 4)
+        self.assertEqual(t[-1], tout[-1])
+
     def test_tcrit(self):
         """ Test critical times """
         # Really only tests that tcrit doesn't mess up integration. The
@@ -244,6 +379,64 @@ class test_lsodar(unittest.TestCase):
         self.assertAlmostEqual(y[1][1], 3.386380e-5, 4)
         self.assertAlmostEqual(y[6][2], 9.610125e-1, 4)
 
+@unittest.skipIf(cfunc is None, 'numba is not available')
+class test_lowlevel(unittest.TestCase):
+    def test_basic(self):
+        """ Basic test of the compiled-callback path """
+        y = lsodar.odeintr_lowlevel(func_ll, y0, t,
+                                    rtol=1e-4, atol=[1e-6, 1e-10, 1e-6])
+
+        self.assertAlmostEqual(y[1][1], 3.386380e-5, 4)
+        self.assertAlmostEqual(y[6][2], 9.610125e-1, 4)
+
+    def test_Dfun(self):
+        """ Test compiled user-supplied Jacobian """
+        y = lsodar.odeintr_lowlevel(func_ll, y0, t, jac_ptr=Dfun_ll,
+                                    rtol=1e-4, atol=[1e-6, 1e-10, 1e-6])
+
+        self.assertAlmostEqual(y[1][1], 3.386380e-5, 4)
+        self.assertAlmostEqual(y[6][2], 9.610125e-1, 4)
+
+    def test_roots(self):
+        """ Test compiled root function """
+        y, tout, t_root, y_root, i_root = \
+                lsodar.odeintr_lowlevel(func_ll, y0, t, jac_ptr=Dfun_ll,
+                                        g_ptr=root_func_ll,
+                                        rtol=1e-4, atol=[1e-6, 1e-10, 1e-6],
+                                        root_term=[0, 0])
+
+        self.assertAlmostEqual(t_root[0], 2.6400e-1, 4)
+        self.assertAlmostEqual(y_root[0][1], 3.470563e-5, 4)
+        self.assertEqual(i_root[0], 1)
+
+    def test_threads(self):
+        """ Test concurrent integrations with compiled callbacks """
+        import threading
+        results = [None]*4
+        def work(ii):
+            results[ii] = lsodar.odeintr_lowlevel(
+                    func_ll, y0, t, jac_ptr=Dfun_ll,
+                    rtol=1e-4, atol=[1e-6, 1e-10, 1e-6])
+        threads = [threading.Thread(target=work, args=(ii,))
+                   for ii in range(len(results))]
+        for th in threads:
+            th.start()
+        for th in threads:
+            th.join()
+        for y in results:
+            self.assertAlmostEqual(y[1][1], 3.386380e-5, 4)
+            self.assertAlmostEqual(y[6][2], 9.610125e-1, 4)
+
+@unittest.skipIf(cfunc is None, 'numba is not available')
+class test_njit(unittest.TestCase):
+    def test_basic(self):
+        """ Test njit'd callbacks through the plain-callable path """
+        y = odeintr(func_jit, y0, t, Dfun=Dfun_jit,
+                    rtol=1e-4, atol=[1e-6, 1e-10, 1e-6])
+
+        self.assertAlmostEqual(y[1][1], 3.386380e-5, 4)
+        self.assertAlmostEqual(y[6][2], 9.610125e-1, 4)
+
 suite = unittest.makeSuite(test_lsodar, 'test lsodar')
 
 if __name__ == '__main__':